@@ -5,8 +5,12 @@ from dotenv import load_dotenv
 import os
 import logging
 import datetime
-import pytz
-import json
+import re
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Literal, Optional
+from cachetools import LRUCache
+from pydantic import BaseModel, ConfigDict, Field
 
 # Importações do Gemini
 from google import genai
@@ -14,12 +18,13 @@ from google.genai import types
 
 # Importações das Ferramentas do Calendar
 from google_calendar_tools import (
-    obter_eventos_por_palavra_chave, 
-    verificar_disponibilidade, 
-    criar_evento, 
-    sugerir_horarios,
-    TIMEZONE_BRAZIL # Importa a constante do fuso horário para uso local
+    aobter_eventos_por_palavra_chave, 
+    acheck_and_suggest, 
+    acriar_evento, 
+    initialize_calendar,
+    FUSO_BRASIL # Importa o fuso horário (já resolvido) para uso local
 )
+from armazenamento_contexto import ContextStore, criar_backend
 
 load_dotenv()
 
@@ -31,21 +36,40 @@ logging.basicConfig(
 # Constantes e Variáveis Globais
 TOKEN_TELEGRAM = os.getenv("TOKEN_TELEGRAM")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY") 
+MAX_WORKERS = 16 # Threads para as chamadas bloqueantes do Calendar
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") # Ex.: https://seu-dominio.com (sem barra final); vazio = polling
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+DIGIT_RE = re.compile(r'^\d+$') # Respostas numéricas do fluxo multi-turno
 
 client = genai.Client(api_key=GEMINI_API_KEY)
-user_context_storage = {} # Memória/Estado para raciocínio multi-turno
+user_context_storage = ContextStore(criar_backend()) # Memória/Estado para raciocínio multi-turno
+
+# Cache das decisões do Gemini, chaveado por (texto normalizado, data atual)
+# Acessado apenas a partir do event loop, portanto dispensa lock.
+_gemini_cache = LRUCache(maxsize=1024)
 
 # --- 2. Schemas e Tools do Gemini ---
 
-AGENDAMENTO_SCHEMA = types.Schema(
-    type=types.Type.OBJECT,
-    properties={
-        "titulo": types.Schema(type=types.Type.STRING, description="O título ou resumo do evento."),
-        "data": types.Schema(type=types.Type.STRING, description="A data do evento, SEMPRE no formato 'YYYY-MM-DD'."),
-        "hora": types.Schema(type=types.Type.STRING, description="A hora do evento no formato 'HH:MM' (24 horas).")
-    },
-    required=["titulo", "data", "hora"]
-)
+class Agendamento(BaseModel):
+    """Parâmetros de data/hora extraídos pelo Gemini para 'agendar' ou 'verificar'."""
+    model_config = ConfigDict(frozen=True)
+
+    titulo: str = Field(description="O título ou resumo do evento.")
+    data: str = Field(description="A data do evento, SEMPRE no formato 'YYYY-MM-DD'.")
+    hora: str = Field(description="A hora do evento no formato 'HH:MM' (24 horas).")
+
+
+class Decision(BaseModel):
+    """Decisão estruturada do Gemini; o SDK a devolve já validada em response.parsed."""
+    model_config = ConfigDict(frozen=True)
+
+    action: Literal['agendar', 'consultar', 'verificar'] = Field(
+        description='A ação principal: "agendar", "consultar" ou "verificar".'
+    )
+    agendamento: Optional[Agendamento] = None
+    consulta: Optional[str] = Field(
+        default=None, description='A palavra-chave para consulta, se a ação for "consultar".'
+    )
 
 CONSULTA_AGENDA_TOOL = types.Tool(
     function_declarations=[
@@ -65,51 +89,107 @@ CONSULTA_AGENDA_TOOL = types.Tool(
 
 # --- 3. Funções de Raciocínio (Gemini Logic) ---
 
-def analisar_e_decidir_acao_com_gemini(texto: str) -> dict | None:
+# Parte fixa do prompt, montada uma única vez
+_PROMPT_INSTRUCOES = (
+    "DECIDA se a intenção é 'agendar', 'consultar' ou 'verificar'. "
+    "Se a intenção for 'consultar', extraia APENAS o assunto principal do evento (ex: 'almoço', 'reunião'). "
+    "Se a intenção for 'agendar' ou 'verificar', converta a data para YYYY-MM-DD. "
+    "Sua resposta DEVE ser um JSON que inclui o campo 'action'."
+)
+
+_today_cache = (None, None) # (date, 'YYYY-MM-DD'); a string só é refeita quando o dia muda
+
+def _data_atual() -> str:
+    """
+    Retorna a data de hoje formatada ('YYYY-MM-DD'), reformatando apenas na virada do dia.
     """
-    Usa o Gemini para analisar a intenção (agendar/consultar) e extrair os parâmetros.
+    global _today_cache
+    today = datetime.date.today()
+    if today != _today_cache[0]:
+        _today_cache = (today, today.strftime('%Y-%m-%d'))
+    return _today_cache[1]
+
+def _normalizar_texto(texto: str) -> str:
+    """
+    Normaliza a mensagem para uso como chave de cache: apenas remove espaços extras.
+    Maiúsculas/minúsculas são preservadas, pois a decisão em cache carrega texto exibido
+    ao usuário (título do evento, palavra-chave da consulta).
+    """
+    return ' '.join(texto.split())
+
+async def analisar_e_decidir_acao_com_gemini(texto: str) -> Decision | None:
+    """
+    Usa o Gemini (cliente assíncrono nativo) para analisar a intenção (agendar/consultar)
+    e extrair os parâmetros.
 
     Args:
         texto: A mensagem de entrada do usuário.
 
     Retorna:
-        Um dicionário JSON com a decisão ('action') e os parâmetros, ou None em caso de erro.
+        A decisão (Decision) com a 'action' e os parâmetros, ou None em caso de erro.
     """
-    today_date = datetime.date.today().strftime('%Y-%m-%d')
+    today_date = _data_atual()
+
+    # A data faz parte da chave, então o cache "gira" naturalmente a cada dia.
+    cache_key = (_normalizar_texto(texto), today_date)
+    cached = _gemini_cache.get(cache_key)
+    if cached is not None:
+        return cached
     
-    prompt = (
-        f"A data atual é {today_date}. Analise o pedido do usuário: '{texto}'. "
-        "DECIDA se a intenção é 'agendar', 'consultar' ou 'verificar'. "
-        "Se a intenção for 'consultar', extraia APENAS o assunto principal do evento (ex: 'almoço', 'reunião'). "
-        "Se a intenção for 'agendar' ou 'verificar', converta a data para YYYY-MM-DD. "
-        "Sua resposta DEVE ser um JSON que inclui o campo 'action'."
-    )
+    prompt = f"A data atual é {today_date}. Analise o pedido do usuário: '{texto}'. {_PROMPT_INSTRUCOES}"
     
     try:
-        response = client.models.generate_content(
+        response = await client.aio.models.generate_content(
             model='gemini-2.5-flash',
             contents=prompt,
             config=types.GenerateContentConfig(
                 response_mime_type="application/json",
-                response_schema=types.Schema(
-                    type=types.Type.OBJECT,
-                    properties={
-                        'action': types.Schema(type=types.Type.STRING, description='A ação principal: "agendar", "consultar" ou "verificar".'),
-                        'agendamento': AGENDAMENTO_SCHEMA,
-                        'consulta': types.Schema(type=types.Type.STRING, description='A palavra-chave para consulta, se a ação for "consultar".')
-                    },
-                    required=['action']
-                ),
+                response_schema=Decision,
             ),
         )
-        return json.loads(response.text)
     except Exception as e:
         logging.error(f"Erro ao chamar a API do Gemini: {e}")
         return None
 
+    decision = response.parsed
+    if not isinstance(decision, Decision):
+        logging.error(f"Resposta do Gemini fora do schema esperado: {response.text}")
+        return None
+
+    usage = response.usage_metadata
+    if usage:
+        logging.info(
+            f"Tokens Gemini: prompt={usage.prompt_token_count}, "
+            f"resposta={usage.candidates_token_count}, total={usage.total_token_count}"
+        )
+
+    # Decision é imutável (frozen), então o próprio objeto pode ser compartilhado pelo cache.
+    _gemini_cache[cache_key] = decision
+    return decision
+
 
 # --- 4. Funções de Execução das Ações ---
 
+def _montar_sugestoes(sugestoes: list[tuple[str, datetime.datetime]]) -> tuple[list[dict], str]:
+    """
+    Monta, em uma única passada, a lista de opções salva no contexto e o texto exibido.
+
+    A opção N é guardada na posição N - 1 de uma lista (em vez de um dicionário com chaves
+    string), o que também sobrevive intacto à serialização JSON dos backends persistentes.
+    Cada opção guarda início, fim e exibição já formatados: o follow-up não reprocessa datas.
+    """
+    suggestion_list = []
+    numbered_suggestions = []
+    for option, (iso_time, dt_obj) in enumerate(sugestoes, start=1):
+        display = dt_obj.strftime('%H:%M')
+        suggestion_list.append({
+            'start_iso': iso_time,
+            'end_iso': (dt_obj + datetime.timedelta(hours=1)).isoformat(),
+            'display': display,
+        })
+        numbered_suggestions.append(f"({option}) às {display}")
+    return suggestion_list, ' ou '.join(numbered_suggestions)
+
 async def execute_consulta(update: Update, context: ContextTypes.DEFAULT_TYPE, keyword: str):
     """
     Executa a lógica de consulta (busca) no calendário.
@@ -120,7 +200,7 @@ async def execute_consulta(update: Update, context: ContextTypes.DEFAULT_TYPE, k
         await context.bot.send_message(chat_id=chat_id, text="Não consegui extrair a palavra-chave para consulta.")
         return
 
-    eventos = obter_eventos_por_palavra_chave(keyword)
+    eventos = await aobter_eventos_por_palavra_chave(keyword)
     
     if eventos:
         response_text = f"Encontrei os seguintes eventos futuros sobre '{keyword}':\n\n"
@@ -132,7 +212,7 @@ async def execute_consulta(update: Update, context: ContextTypes.DEFAULT_TYPE, k
     await context.bot.send_message(chat_id=chat_id, text=response_text)
 
 
-async def execute_agendamento(update: Update, context: ContextTypes.DEFAULT_TYPE, entidades: dict):
+async def execute_agendamento(update: Update, context: ContextTypes.DEFAULT_TYPE, entidades: Agendamento | None):
     """
     Executa a lógica principal de agendamento (Validação, Verificação, Criação).
     Lida com o fluxo multi-turno de sugestão de horários.
@@ -141,56 +221,53 @@ async def execute_agendamento(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     try:
         # 1. Validação e Formatação Inicial
-        if not entidades or not entidades.get('titulo') or not entidades.get('hora'):
+        if not entidades or not entidades.titulo or not entidades.hora:
             raise ValueError("Dados incompletos do Gemini.")
 
-        resumo = entidades["titulo"]
-        data_alvo_str = entidades["data"].strip()
+        resumo = entidades.titulo
+        data_alvo_str = entidades.data.strip()
 
         data_alvo = datetime.datetime.strptime(data_alvo_str, '%Y-%m-%d').date()
-        hora, minuto = map(int, entidades["hora"].split(':'))
-        fuso_brasil = pytz.timezone(TIMEZONE_BRAZIL)
+        hora, minuto = map(int, entidades.hora.split(':'))
 
         # 2. Formatação ISO com Fuso Horário
         # Assume 1 hora de duração padrão para o evento
-        inicio_com_fuso = fuso_brasil.localize(datetime.datetime.combine(data_alvo, datetime.time(hora, minuto)))
+        inicio_com_fuso = datetime.datetime.combine(data_alvo, datetime.time(hora, minuto), tzinfo=FUSO_BRASIL)
         fim_com_fuso = inicio_com_fuso + datetime.timedelta(hours=1)
         inicio_iso = inicio_com_fuso.isoformat()
         fim_iso = fim_com_fuso.isoformat()
+        display_time = inicio_com_fuso.strftime('%H:%M')
 
     except Exception as e:
         logging.error(f"Erro na conversão de dados do agendamento: {e}")
         await context.bot.send_message(chat_id=chat_id, text="Houve um erro na conversão dos dados do agendamento. Tente um formato de data/hora mais claro.")
         return
 
-    # 3. AÇÃO: Verificar Disponibilidade
-    disponivel = verificar_disponibilidade(inicio_iso, fim_iso)
+    # 3. AÇÃO: Verificar Disponibilidade (e já obter sugestões, na mesma consulta)
+    disponivel, sugestoes = await acheck_and_suggest(inicio_iso, fim_iso)
 
     if disponivel:
         # 3.1. Criar Evento Imediatamente
-        link_evento = criar_evento(resumo, inicio_iso, fim_iso)
+        link_evento = await acriar_evento(resumo, inicio_iso, fim_iso)
         texto_resposta = (
             f"✅ Perfeito! O evento '{resumo}' foi agendado para "
-            f"{data_alvo.strftime('%d/%m/%Y')} às {inicio_com_fuso.strftime('%H:%M')}. "
+            f"{data_alvo.strftime('%d/%m/%Y')} às {display_time}. "
             f"Veja no seu calendário: {link_evento}"
         )
     else:
         # 3.2. Sugerir Horários (Inicia o fluxo Multi-Turno)
-        sugestoes = sugerir_horarios(inicio_iso, fim_iso)
         if sugestoes:
-            suggestion_map = {}
-            numbered_suggestions = []
-            for i, iso_time in enumerate(sugestoes):
-                dt_obj = datetime.datetime.fromisoformat(iso_time)
-                suggestion_map[f"{i + 1}"] = iso_time
-                numbered_suggestions.append(f"({i + 1}) às {dt_obj.strftime('%H:%M')}")
+            suggestion_list, sugestoes_str = _montar_sugestoes(sugestoes)
             
             # Salva o contexto na memória
-            user_context_storage[chat_id] = {'summary': resumo, 'suggestions': suggestion_map}
+            await user_context_storage.set(chat_id, {
+                'action': 'awaiting_time_selection',
+                'summary': resumo,
+                'suggestions': suggestion_list
+            })
             
-            sugestoes_str = ' ou '.join(numbered_suggestions)
             texto_resposta = (
-                f"❌ O horário solicitado ({inicio_com_fuso.strftime('%H:%M')}) está ocupado. "
+                f"❌ O horário solicitado ({display_time}) está ocupado. "
                 f"Que tal uma dessas opções: {sugestoes_str}? "
                 f"Responda com o número da opção desejada (ex: '1')."
             )
@@ -199,7 +276,7 @@ async def execute_agendamento(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     await context.bot.send_message(chat_id=chat_id, text=texto_resposta)
 
-async def execute_verificacao(update: Update, context: ContextTypes.DEFAULT_TYPE, entidades: dict):
+async def execute_verificacao(update: Update, context: ContextTypes.DEFAULT_TYPE, entidades: Agendamento | None):
     """
     Executa a lógica de verificação de disponibilidade em um horário específico.
     """
@@ -207,52 +284,42 @@ async def execute_verificacao(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     try:
         # 1. Validação e Formatação Inicial (o mesmo do agendamento)
-        if not entidades or not entidades.get('data') or not entidades.get('hora'):
+        if not entidades or not entidades.data or not entidades.hora:
             raise ValueError("Dados de data/hora incompletos do Gemini.")
 
-        data_alvo_str = entidades["data"].strip()
+        data_alvo_str = entidades.data.strip()
         data_alvo = datetime.datetime.strptime(data_alvo_str, '%Y-%m-%d').date()
-        hora, minuto = map(int, entidades["hora"].split(':'))
-        fuso_brasil = pytz.timezone(TIMEZONE_BRAZIL)
+        hora, minuto = map(int, entidades.hora.split(':'))
 
         # 2. Formatação ISO com Fuso Horário (Assume 1 hora de duração padrão para a verificação)
-        inicio_com_fuso = fuso_brasil.localize(datetime.datetime.combine(data_alvo, datetime.time(hora, minuto)))
+        inicio_com_fuso = datetime.datetime.combine(data_alvo, datetime.time(hora, minuto), tzinfo=FUSO_BRASIL)
         fim_com_fuso = inicio_com_fuso + datetime.timedelta(hours=1)
         inicio_iso = inicio_com_fuso.isoformat()
         fim_iso = fim_com_fuso.isoformat()
+        data_formatada = inicio_com_fuso.strftime('%d/%m às %H:%M')
 
     except Exception as e:
         logging.error(f"Erro na conversão de dados da verificação: {e}")
         await context.bot.send_message(chat_id=chat_id, text="Houve um erro na conversão da data/hora. Tente um formato mais claro.")
         return
 
-    # 3. AÇÃO: Verificar Disponibilidade
-    disponivel = verificar_disponibilidade(inicio_iso, fim_iso)
+    # 3. AÇÃO: Verificar Disponibilidade (e já obter sugestões, na mesma consulta)
+    disponivel, sugestoes = await acheck_and_suggest(inicio_iso, fim_iso)
     
     # 4. Construir Resposta
-    data_formatada = inicio_com_fuso.strftime('%d/%m às %H:%M')
-
     if disponivel:
         texto_resposta = f"✅ **Confirmado!** Você está livre no dia {data_formatada}."
     else:
         # Sugere horários alternativos se o principal estiver ocupado
-        sugestoes = sugerir_horarios(inicio_iso, fim_iso)
-        
         if sugestoes:
-            suggestion_map = {}
-            numbered_suggestions = []
-            for i, iso_time in enumerate(sugestoes):
-                dt_obj = datetime.datetime.fromisoformat(iso_time)
-                suggestion_map[f"{i + 1}"] = iso_time
-                numbered_suggestions.append(f"({i + 1}) às {dt_obj.strftime('%H:%M')}")
+            suggestion_list, sugestoes_str = _montar_sugestoes(sugestoes)
 
             # Salva o contexto na memória
-            user_context_storage[chat_id] = {
+            await user_context_storage.set(chat_id, {
                 'action': 'awaiting_time_selection',
-                'suggestions': suggestion_map
-            }
+                'suggestions': suggestion_list
+            })
 
-            sugestoes_str = ' ou '.join(numbered_suggestions)
             texto_resposta = (
                 f"❌ Ocupado. Você tem compromisso no dia {data_formatada}. "
                 f"Encontrei disponibilidade para: {sugestoes_str}."
@@ -281,114 +348,129 @@ async def handle_follow_up(update: Update, context: ContextTypes.DEFAULT_TYPE):
     Unifica a lógica de agendamento e verificação.
     """
     chat_id = update.effective_chat.id
-    user_response = update.message.text.strip()
-    
-    if chat_id not in user_context_storage:
-        return False # Sem contexto, passa para o próximo handler
-        
-    context_data = user_context_storage[chat_id]
-    action = context_data.get('action')
 
-    # TRATAMENTO DE SELEÇÃO DE HORÁRIO (Estado: awaiting_time_selection)
-    if action == 'awaiting_time_selection' and user_response.isdigit():
-        suggestions = context_data['suggestions']
-        
-        if user_response in suggestions:
-            chosen_iso_time = suggestions[user_response]
-            
-            # --- Lógica de Transição: Agendamento Original vs. Verificação ---
+    async with user_context_storage.lock(chat_id):
+        # Consulta o estado antes de qualquer processamento do texto.
+        context_data = await user_context_storage.get(chat_id)
+        if context_data is None:
+            return False # Sem contexto, passa para o próximo handler
+
+        # TRATAMENTO DE SELEÇÃO DE HORÁRIO (Estado: awaiting_time_selection)
+        # O filtro DIGIT_RE do handler já garante que a mensagem é numérica.
+        if context_data.get('action') == 'awaiting_time_selection':
+            user_response = update.message.text.strip()
+            suggestions = context_data['suggestions']
+            option = int(user_response) # A opção N corresponde a suggestions[N - 1]
             
-            # Se o RESUMO/TÍTULO já existe (veio de um comando 'agendar' original), agenda imediatamente.
-            if 'summary' in context_data:
-                summary = context_data['summary']
+            if 1 <= option <= len(suggestions):
+                chosen = suggestions[option - 1]
                 
-                chosen_start_dt = datetime.datetime.fromisoformat(chosen_iso_time)
-                chosen_end_dt = (chosen_start_dt + datetime.timedelta(hours=1)).isoformat()
-                link = criar_evento(summary, chosen_iso_time, chosen_end_dt)
+                # --- Lógica de Transição: Agendamento Original vs. Verificação ---
                 
-                del user_context_storage[chat_id]
-                
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"✅ Agendamento Confirmado! O evento '{summary}' foi marcado para as {chosen_start_dt.strftime('%H:%M')}. Veja: {link}"
-                )
-                return True # Finaliza o agendamento
-                
-            # Se o RESUMO/TÍTULO NÃO existe (veio de um comando 'verificar'), pede o título.
+                # Se o RESUMO/TÍTULO já existe (veio de um comando 'agendar' original), agenda imediatamente.
+                if 'summary' in context_data:
+                    # Remove o contexto ANTES de criar o evento, impedindo agendamento duplicado.
+                    context_data = await user_context_storage.pop_if(chat_id, action='awaiting_time_selection')
+                    if context_data is None:
+                        return True
+                    summary = context_data['summary']
+                    
+                    link = await acriar_evento(summary, chosen['start_iso'], chosen['end_iso'])
+                    
+                    await context.bot.send_message(
+                        chat_id=chat_id,
+                        text=f"✅ Agendamento Confirmado! O evento '{summary}' foi marcado para as {chosen['display']}. Veja: {link}"
+                    )
+                    return True # Finaliza o agendamento
+                    
+                # Se o RESUMO/TÍTULO NÃO existe (veio de um comando 'verificar'), pede o título.
+                else:
+                    # ATUALIZA O ESTADO para AWAITING_TITLE, armazenando o horário escolhido
+                    await user_context_storage.set(chat_id, {
+                        'action': 'awaiting_title',
+                        'chosen_time': chosen,
+                    })
+                    
+                    # Pede o título do evento
+                    await context.bot.send_message(
+                        chat_id=chat_id,
+                        text="Ótimo! Horário selecionado. Agora, **qual será o título/resumo** deste evento?"
+                    )
+                    return True # Processamento multi-turno completo
             else:
-                # ATUALIZA O ESTADO para AWAITING_TITLE, armazenando o horário escolhido
-                user_context_storage[chat_id] = {
-                    'action': 'awaiting_title',
-                    'chosen_time_iso': chosen_iso_time,
-                }
-                
-                # Pede o título do evento
                 await context.bot.send_message(
                     chat_id=chat_id,
-                    text="Ótimo! Horário selecionado. Agora, **qual será o título/resumo** deste evento?"
+                    text="Opção inválida. Por favor, responda apenas com o número da opção (ex: '1', '2', etc.)."
                 )
-                return True # Processamento multi-turno completo
-        else:
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text="Opção inválida. Por favor, responda apenas com o número da opção (ex: '1', '2', etc.)."
-            )
+                return True
+
+        # Título numérico de um estado 'awaiting_title' que o AwaitingTitleFilter não viu
+        # (gravado após o filtro ser avaliado ou por outro worker): conclui aqui em vez de descartar.
+        if context_data.get('action') == 'awaiting_title':
+            context_data = await user_context_storage.pop_if(chat_id, action='awaiting_title')
+            if context_data is not None:
+                await _concluir_com_titulo(update, context, context_data)
             return True
     
     return False # Passa para o próximo handler se não for uma seleção numérica válida
 
 
-async def handle_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
+class AwaitingTitleFilter(filters.MessageFilter):
     """
-    Handler geral: Processa todas as mensagens de texto.
-    Usa o Gemini para decidir a intenção e encaminha a ação.
+    Filtro do dispatcher: aceita apenas mensagens de chats no estado 'awaiting_title'.
+    Consulta só o índice local do ContextStore; os casos que ele não vê são tratados
+    em handle_messages e handle_follow_up, já sob o lock do chat.
     """
-    full_message = update.message.text
-    chat_id = update.effective_chat.id
 
-    # 1. VERIFICAÇÃO DE ESTADO MULTI-TURNO: AWAITING TITLE
-    if chat_id in user_context_storage:
-        context_data = user_context_storage[chat_id]
-        if context_data.get('action') == 'awaiting_title':
-            
-            # AÇÃO: Finalizar o Agendamento com Título Fornecido
-            summary = full_message # O texto do usuário é o novo título
-            chosen_iso_time = context_data['chosen_time_iso']
+    def __init__(self, context_store: ContextStore):
+        super().__init__(name='AwaitingTitleFilter')
+        self._context_store = context_store
+
+    def filter(self, message) -> bool:
+        return self._context_store.peek_action(message.chat_id) == 'awaiting_title'
 
-            chosen_start_dt = datetime.datetime.fromisoformat(chosen_iso_time)
-            chosen_end_dt = (chosen_start_dt + datetime.timedelta(hours=1)).isoformat()
-            
-            link = criar_evento(summary, chosen_iso_time, chosen_end_dt)
-            
-            # Limpa a memória para o próximo comando
-            del user_context_storage[chat_id]
-            
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=f"✅ Agendamento Confirmado! O evento '{summary}' foi marcado para as {chosen_start_dt.strftime('%H:%M')}. Veja: {link}"
-            )
-            return # Processamento multi-turno completo, não continua para o Gemini.
 
-    # 2. RACIOCÍNIO: Decisão de Ação (Gemini)
-    decision = analisar_e_decidir_acao_com_gemini(full_message)
+async def _concluir_com_titulo(update: Update, context: ContextTypes.DEFAULT_TYPE, context_data: dict):
+    """
+    Cria o evento do estado 'awaiting_title' (já removido do store) usando a mensagem como título.
+    """
+    summary = update.message.text # O texto do usuário é o novo título
+    chosen = context_data['chosen_time']
+
+    link = await acriar_evento(summary, chosen['start_iso'], chosen['end_iso'])
+
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=f"✅ Agendamento Confirmado! O evento '{summary}' foi marcado para as {chosen['display']}. Veja: {link}"
+    )
+
+
+async def _decidir_e_executar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Usa o Gemini para decidir a intenção e encaminha a ação. Quem chama deve segurar o lock do chat.
+    """
+    chat_id = update.effective_chat.id
+
+    # RACIOCÍNIO: Decisão de Ação (Gemini)
+    decision = await analisar_e_decidir_acao_com_gemini(update.message.text)
     
     if not decision:
         await context.bot.send_message(chat_id=chat_id, text="Não consegui processar sua solicitação. Tente de novo.")
         return
 
-    action = decision.get('action')
+    action = decision.action
 
     if action == 'agendar':
-        # 2.1. AÇÃO: Executa a lógica de AGENDAMENTO
-        await execute_agendamento(update, context, decision.get('agendamento'))
+        # 1. AÇÃO: Executa a lógica de AGENDAMENTO
+        await execute_agendamento(update, context, decision.agendamento)
 
     elif action == 'verificar':
-        # 2.2. AÇÃO: Executa a lógica de VERIFICAÇÃO
-        await execute_verificacao(update, context, decision.get('agendamento'))
+        # 2. AÇÃO: Executa a lógica de VERIFICAÇÃO
+        await execute_verificacao(update, context, decision.agendamento)
         
     elif action == 'consultar':
-        # 2.3. AÇÃO: Executa a lógica de CONSULTA
-        await execute_consulta(update, context, decision.get('consulta'))
+        # 3. AÇÃO: Executa a lógica de CONSULTA
+        await execute_consulta(update, context, decision.consulta)
         
     else:
         # Resposta padrão se o Gemini retornar uma ação desconhecida ou vazia
@@ -398,20 +480,107 @@ async def handle_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
+async def handle_title_completion(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handler multi-turno: Finaliza o agendamento usando a mensagem do usuário como título.
+    Só é acionado pelo AwaitingTitleFilter.
+    """
+    chat_id = update.effective_chat.id
+
+    async with user_context_storage.lock(chat_id):
+        # A remoção atômica garante que a finalização não seja reexecutada.
+        context_data = await user_context_storage.pop_if(chat_id, action='awaiting_title')
+        if context_data is not None:
+            await _concluir_com_titulo(update, context, context_data)
+            return # Processamento multi-turno completo, não continua para o Gemini.
+
+        # O estado mudou entre o filtro e o lock: trata como mensagem comum.
+        await _decidir_e_executar(update, context)
+
+
+async def handle_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handler geral: Processa todas as mensagens de texto.
+    Usa o Gemini para decidir a intenção e encaminha a ação.
+    """
+    chat_id = update.effective_chat.id
+
+    async with user_context_storage.lock(chat_id):
+        # O filtro é avaliado antes de o lock ser obtido, então um 'awaiting_title' gravado por
+        # um handler anterior do mesmo chat (concurrent_updates) só é visto aqui. O índice local
+        # basta; o backend só é consultado quando é compartilhado com outros workers.
+        if user_context_storage.may_be(chat_id, 'awaiting_title'):
+            context_data = await user_context_storage.pop_if(chat_id, action='awaiting_title')
+            if context_data is not None:
+                await _concluir_com_titulo(update, context, context_data)
+                return
+
+        await _decidir_e_executar(update, context)
+
+
 # --- 6. Configuração Principal do App ---
 
+async def inicializar_app(app):
+    """
+    Define um ThreadPoolExecutor limitado como executor padrão do event loop,
+    usado pelas versões assíncronas das ferramentas do Calendar (asyncio.to_thread),
+    e reconstrói o índice de estados multi-turno a partir do backend de contexto.
+    """
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=MAX_WORKERS))
+    await user_context_storage.load_index()
+
+
+async def fechar_contexto(app):
+    """Fecha a conexão com o backend de contexto ao encerrar o app."""
+    await user_context_storage.close()
+
+
 if __name__ == '__main__':
-    app = ApplicationBuilder().token(TOKEN_TELEGRAM).build()
+    # uvloop (opcional) substitui o event loop padrão por uma implementação mais rápida
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+
+    # Autentica e constrói o serviço do Calendar antes de aceitar mensagens
+    initialize_calendar()
+
+    # concurrent_updates(True): chats diferentes são processados em paralelo;
+    # a ordem dentro de um mesmo chat é garantida pelo lock do ContextStore.
+    app = (
+        ApplicationBuilder()
+        .token(TOKEN_TELEGRAM)
+        .concurrent_updates(True)
+        .post_init(inicializar_app)
+        .post_shutdown(fechar_contexto)
+        .build()
+    )
 
     # Handlers de Comando
     app.add_handler(CommandHandler('start', iniciar_handler))
 
-    # Handlers de Mensagens (Ordem crucial: follow-up > geral)
-    # 1. Handler para respostas numéricas (raciocínio multi-turno)
-    # filters.Regex(r'^\d+$') garante que apenas números sejam processados aqui.
-    app.add_handler(MessageHandler(filters.Regex(r'^\d+$') & (~filters.COMMAND), handle_follow_up))
+    # Handlers de Mensagens (Ordem crucial: título > follow-up > geral)
+    # 1. Handler para o título do evento (estado 'awaiting_title'), roteado pelo próprio dispatcher
+    app.add_handler(MessageHandler(
+        AwaitingTitleFilter(user_context_storage) & filters.TEXT & (~filters.COMMAND),
+        handle_title_completion
+    ))
+
+    # 2. Handler para respostas numéricas (raciocínio multi-turno)
+    # filters.Regex(DIGIT_RE) garante que apenas números sejam processados aqui.
+    app.add_handler(MessageHandler(filters.Regex(DIGIT_RE) & (~filters.COMMAND), handle_follow_up))
     
-    # 2. Handler geral para o raciocínio de intenção (Gemini)
+    # 3. Handler geral para o raciocínio de intenção (Gemini)
     app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_messages))
 
-    app.run_polling()
\ No newline at end of file
+    if WEBHOOK_URL:
+        # Webhook: o Telegram envia as atualizações, sem o custo do long polling
+        app.run_webhook(
+            listen='0.0.0.0',
+            port=WEBHOOK_PORT,
+            url_path=TOKEN_TELEGRAM,
+            webhook_url=f"{WEBHOOK_URL}/{TOKEN_TELEGRAM}",
+        )
+    else:
+        app.run_polling()
\ No newline at end of file
@@ -0,0 +1,323 @@
+# Importações de Bibliotecas
+import os
+import json
+import time
+import asyncio
+import logging
+import weakref
+from typing import Protocol
+
+# --- Configuração Global ---
+# Tempo de vida padrão (segundos) de um estado multi-turno; estados antigos expiram sozinhos.
+CONTEXT_TTL = 1800
+
+# --- Backends de Persistência ---
+
+class ContextBackend(Protocol):
+    """
+    Interface mínima de armazenamento chave-valor para o estado multi-turno de cada chat.
+    'shared' indica se outros processos podem gravar no mesmo armazenamento.
+    """
+
+    shared: bool
+
+    async def get(self, chat_id: int) -> dict | None: ...
+
+    async def set(self, chat_id: int, data: dict, ttl: int = CONTEXT_TTL) -> None: ...
+
+    async def delete(self, chat_id: int) -> None: ...
+
+    async def pop(self, chat_id: int) -> dict | None:
+        """Remove e retorna o estado do chat em uma única operação atômica (None se não houver)."""
+        ...
+
+    async def items(self) -> list[tuple[int, dict]]: ...
+
+    async def close(self) -> None: ...
+
+
+class MemoryBackend:
+    """
+    Backend em memória do processo (padrão). Não sobrevive a reinícios.
+    """
+
+    shared = False
+
+    def __init__(self):
+        self._data = {}
+        self._next_prune = time.time() + CONTEXT_TTL
+
+    async def get(self, chat_id: int) -> dict | None:
+        entry = self._data.get(chat_id)
+        if entry is None:
+            return None
+        data, expires_at = entry
+        if expires_at <= time.time():
+            del self._data[chat_id]
+            return None
+        return data
+
+    async def set(self, chat_id: int, data: dict, ttl: int = CONTEXT_TTL) -> None:
+        now = time.time()
+        self._data[chat_id] = (data, now + ttl)
+
+        # Como no SqliteBackend, a escrita remove estados expirados de chats que não voltaram.
+        if now >= self._next_prune:
+            self._data = {k: v for k, v in self._data.items() if v[1] > now}
+            self._next_prune = now + CONTEXT_TTL
+
+    async def delete(self, chat_id: int) -> None:
+        self._data.pop(chat_id, None)
+
+    async def pop(self, chat_id: int) -> dict | None:
+        entry = self._data.pop(chat_id, None)
+        if entry is None or entry[1] <= time.time():
+            return None
+        return entry[0]
+
+    async def items(self) -> list[tuple[int, dict]]:
+        now = time.time()
+        return [(chat_id, data) for chat_id, (data, expires_at) in self._data.items() if expires_at > now]
+
+    async def close(self) -> None:
+        pass
+
+
+class RedisBackend:
+    """
+    Backend Redis (redis.asyncio): compartilha o estado entre processos e expira via TTL nativo.
+    """
+
+    shared = True
+
+    _PREFIX = "agente:contexto:"
+
+    def __init__(self, url: str):
+        import redis.asyncio as redis
+
+        self._redis = redis.from_url(url, decode_responses=True)
+
+    @classmethod
+    def _key(cls, chat_id: int) -> str:
+        return f"{cls._PREFIX}{chat_id}"
+
+    async def get(self, chat_id: int) -> dict | None:
+        raw = await self._redis.get(self._key(chat_id))
+        return json.loads(raw) if raw is not None else None
+
+    async def set(self, chat_id: int, data: dict, ttl: int = CONTEXT_TTL) -> None:
+        await self._redis.set(self._key(chat_id), json.dumps(data), ex=ttl)
+
+    async def delete(self, chat_id: int) -> None:
+        await self._redis.delete(self._key(chat_id))
+
+    async def pop(self, chat_id: int) -> dict | None:
+        # GETDEL (Redis >= 6.2): dois processos nunca recebem o mesmo estado.
+        raw = await self._redis.getdel(self._key(chat_id))
+        return json.loads(raw) if raw is not None else None
+
+    async def items(self) -> list[tuple[int, dict]]:
+        results = []
+        async for key in self._redis.scan_iter(match=f"{self._PREFIX}*"):
+            raw = await self._redis.get(key)
+            if raw is not None:
+                results.append((int(key[len(self._PREFIX):]), json.loads(raw)))
+        return results
+
+    async def close(self) -> None:
+        await self._redis.aclose()
+
+
+class SqliteBackend:
+    """
+    Backend SQLite (aiosqlite): persiste o estado em disco, sem servidor externo.
+    Pensado para um único processo; para vários workers, use o RedisBackend.
+    """
+
+    shared = False
+
+    def __init__(self, path: str):
+        self._path = path
+        self._db = None
+        self._init_lock = asyncio.Lock()
+
+    async def _conn(self):
+        if self._db is not None:
+            return self._db
+        async with self._init_lock:
+            if self._db is None:
+                import aiosqlite
+
+                db = await aiosqlite.connect(self._path)
+                await db.execute(
+                    "CREATE TABLE IF NOT EXISTS contexto ("
+                    "chat_id INTEGER PRIMARY KEY, json TEXT NOT NULL, expires_at INTEGER NOT NULL)"
+                )
+                await db.execute("CREATE INDEX IF NOT EXISTS idx_contexto_expires_at ON contexto (expires_at)")
+                await db.commit()
+                self._db = db
+        return self._db
+
+    async def get(self, chat_id: int) -> dict | None:
+        db = await self._conn()
+        async with db.execute(
+            "SELECT json FROM contexto WHERE chat_id = ? AND expires_at > ?",
+            (chat_id, int(time.time()))
+        ) as cursor:
+            row = await cursor.fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def set(self, chat_id: int, data: dict, ttl: int = CONTEXT_TTL) -> None:
+        db = await self._conn()
+        now = int(time.time())
+        # Aproveita a escrita para remover estados expirados (usa o índice em expires_at).
+        await db.execute("DELETE FROM contexto WHERE expires_at <= ?", (now,))
+        await db.execute(
+            "INSERT OR REPLACE INTO contexto (chat_id, json, expires_at) VALUES (?, ?, ?)",
+            (chat_id, json.dumps(data), now + ttl)
+        )
+        await db.commit()
+
+    async def delete(self, chat_id: int) -> None:
+        db = await self._conn()
+        await db.execute("DELETE FROM contexto WHERE chat_id = ?", (chat_id,))
+        await db.commit()
+
+    async def pop(self, chat_id: int) -> dict | None:
+        db = await self._conn()
+        # DELETE ... RETURNING (SQLite >= 3.35) lê e remove na mesma instrução.
+        async with db.execute(
+            "DELETE FROM contexto WHERE chat_id = ? RETURNING json, expires_at", (chat_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+        await db.commit()
+        if row is None or row[1] <= int(time.time()):
+            return None
+        return json.loads(row[0])
+
+    async def items(self) -> list[tuple[int, dict]]:
+        db = await self._conn()
+        async with db.execute(
+            "SELECT chat_id, json FROM contexto WHERE expires_at > ?", (int(time.time()),)
+        ) as cursor:
+            rows = await cursor.fetchall()
+        return [(chat_id, json.loads(raw)) for chat_id, raw in rows]
+
+    async def close(self) -> None:
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+
+def criar_backend() -> ContextBackend:
+    """
+    Seleciona o backend pela variável de ambiente CONTEXT_BACKEND ('memory', 'redis' ou 'sqlite').
+    """
+    backend = os.getenv("CONTEXT_BACKEND", "memory").lower()
+
+    if backend == "redis":
+        return RedisBackend(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    if backend == "sqlite":
+        return SqliteBackend(os.getenv("CONTEXT_SQLITE_PATH", "contexto.db"))
+    if backend != "memory":
+        logging.warning(f"CONTEXT_BACKEND desconhecido '{backend}', usando memória.")
+    return MemoryBackend()
+
+# --- Store com Lock por Chat ---
+
+class ContextStore:
+    """
+    Memória/Estado para raciocínio multi-turno, com um asyncio.Lock por chat.
+
+    Handlers do mesmo chat são serializados pelo lock (preservando a ordem das mensagens),
+    enquanto chats diferentes continuam livres para intercalar no event loop.
+    Os dados em si ficam no ContextBackend configurado; o store mantém apenas um índice
+    síncrono (chat_id -> action) para os filtros do dispatcher, que não podem usar await.
+    Com um backend exclusivo do processo, o índice reflete todas as escritas e é a fonte
+    da verdade para o roteamento; com um backend compartilhado, estados gravados por outros
+    processos não aparecem nele, e o roteamento precisa confirmar no backend (may_be).
+    """
+
+    def __init__(self, backend: ContextBackend):
+        self._backend = backend
+        # Referências fracas: o lock de um chat existe apenas enquanto algum handler o usa
+        # (segurando-o ou aguardando-o), então a memória não cresce com cada chat já visto.
+        self._locks = weakref.WeakValueDictionary()
+        # chat_id -> (action, expira_em); entradas vencidas são podadas periodicamente,
+        # pois um estado pode expirar no backend sem que o chat volte a enviar mensagens.
+        self._actions = {}
+        self._next_prune = time.monotonic() + CONTEXT_TTL
+
+    def lock(self, chat_id: int) -> asyncio.Lock:
+        """Retorna o lock exclusivo do chat. Use com 'async with'."""
+        lock = self._locks.get(chat_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[chat_id] = lock
+        return lock
+
+    def peek_action(self, chat_id: int) -> str | None:
+        """Retorna a 'action' atual do chat sem acessar o backend (uso em filtros síncronos)."""
+        entry = self._actions.get(chat_id)
+        if entry is None:
+            return None
+        action, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._actions[chat_id]
+            return None
+        return action
+
+    def may_be(self, chat_id: int, action: str) -> bool:
+        """
+        Indica se o estado do chat pode ser 'action' sem acessar o backend: consulta o índice
+        e, se o backend for compartilhado, responde True para que quem chama confirme no backend.
+        """
+        return self._backend.shared or self.peek_action(chat_id) == action
+
+    def _index(self, chat_id: int, data: dict | None) -> None:
+        now = time.monotonic()
+        if data is None:
+            self._actions.pop(chat_id, None)
+        else:
+            self._actions[chat_id] = (data.get('action'), now + CONTEXT_TTL)
+
+        if now >= self._next_prune:
+            self._actions = {k: v for k, v in self._actions.items() if v[1] > now}
+            self._next_prune = now + CONTEXT_TTL
+
+    async def load_index(self) -> None:
+        """Reconstrói o índice de actions a partir do backend (ex.: após um reinício)."""
+        for chat_id, data in await self._backend.items():
+            self._index(chat_id, data)
+
+    async def get(self, chat_id: int) -> dict | None:
+        context_data = await self._backend.get(chat_id)
+        self._index(chat_id, context_data)
+        return context_data
+
+    async def set(self, chat_id: int, data: dict) -> None:
+        await self._backend.set(chat_id, data)
+        self._index(chat_id, data)
+
+    async def pop_if(self, chat_id: int, action: str) -> dict | None:
+        """
+        Remove e retorna o contexto do chat somente se o estado atual for 'action'.
+        Garante que um fluxo de finalização não seja executado duas vezes, mesmo entre
+        processos que compartilham o backend: a remoção usa o pop atômico do backend.
+        """
+        # Leitura prévia: o caso comum (sem estado ou outro estado) não escreve no backend.
+        current = await self.get(chat_id)
+        if current is None or current.get('action') != action:
+            return None
+
+        context_data = await self._backend.pop(chat_id)
+        if context_data is not None and context_data.get('action') != action:
+            # Outro processo trocou o estado entre a leitura e o pop: devolve-o intacto.
+            await self._backend.set(chat_id, context_data)
+            self._index(chat_id, context_data)
+            return None
+        self._index(chat_id, None)
+        return context_data
+
+    async def close(self) -> None:
+        await self._backend.close()
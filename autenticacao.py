@@ -9,14 +9,21 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 # 1. Definimos o nível de acesso que nosso agente precisa.
 #    "readonly" seria apenas para leitura, mas precisamos de "events" para criar eventos.
 #    "https://www.googleapis.com/auth/calendar.events" permite leitura e escrita de eventos.
-SCOPES = ["https://www.googleapis.com/auth/calendar.events"]
+#    "https://www.googleapis.com/auth/calendar.freebusy" permite consultar os horários ocupados.
+SCOPES = [
+    "https://www.googleapis.com/auth/calendar.events",
+    "https://www.googleapis.com/auth/calendar.freebusy",
+]
 
 def main():
     creds = None
     # 2. Verificamos se já existe um arquivo "token.json".
     #    Se sim, significa que já fizemos a autenticação e podemos pular para o próximo passo.
+    #    O token é lido com os escopos que foram concedidos; se faltar algum, autenticamos de novo.
     if os.path.exists("token.json"):
-        creds = Credentials.from_authorized_user_file("token.json", SCOPES)
+        creds = Credentials.from_authorized_user_file("token.json")
+        if not creds.has_scopes(SCOPES):
+            creds = None
 
     # 3. Se não houver credenciais válidas, iniciamos o processo de autenticação.
     if not creds or not creds.valid:
@@ -1,18 +1,50 @@
 # Importações de Bibliotecas
 import os
+import asyncio
 import datetime
+import functools
+import json
 import logging
-import pytz
+import threading
+import httplib2
 import unicodedata
+from zoneinfo import ZoneInfo
+from cachetools import TTLCache
 from google.auth.transport.requests import Request
+from google.oauth2 import service_account
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
 
 # --- Configuração Global ---
-# Escopo necessário para acesso de escrita e leitura de eventos
-SCOPES = ["https://www.googleapis.com/auth/calendar.events"]
+# Escopos necessários: leitura e escrita de eventos, e consultas FreeBusy
+SCOPES = [
+    "https://www.googleapis.com/auth/calendar.events",
+    "https://www.googleapis.com/auth/calendar.freebusy",
+]
 TIMEZONE_BRAZIL = 'America/Sao_Paulo'
+FUSO_BRASIL = ZoneInfo(TIMEZONE_BRAZIL)
+# Documento de discovery fixado localmente (opcional); sem ele, usa o que acompanha a biblioteca
+DISCOVERY_FILE = 'calendar_v3_discovery.json'
+
+# Cache do serviço e das credenciais, reaproveitados entre as chamadas das ferramentas
+_SERVICE = None
+_CREDS = None
+_TOKEN_JSON = None # Último conteúdo gravado em 'token.json'
+_SERVICE_LOCK = threading.Lock()
+# Um AuthorizedHttp por thread do pool: reaproveita as conexões TCP/TLS sem compartilhar o httplib2
+_THREAD_HTTP = threading.local()
+# Desligado após um 403 do FreeBusy: as consultas seguintes vão direto ao lote de eventos
+_FREEBUSY_ATIVO = True
+
+# Cache de curta duração das verificações de disponibilidade, chaveado por (inicio_iso, fim_iso)
+_avail_cache = TTLCache(maxsize=512, ttl=30)
+_avail_cache_lock = threading.RLock()
+# Incrementada a cada evento criado: respostas obtidas antes da criação não entram no cache
+_avail_cache_geracao = 0
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -21,42 +53,140 @@ logging.basicConfig(
 
 # --- Funções Auxiliares ---
 
+# Tabela pré-computada para os diacríticos do português (caminho rápido da normalização)
+_ACCENT_MAP = str.maketrans(
+    'áàâãäéèêëíìîïóòôõöúùûüçÁÀÂÃÄÉÈÊËÍÌÎÏÓÒÔÕÖÚÙÛÜÇñÑ',
+    'aaaaaeeeeiiiiooooouuuucAAAAAEEEEIIIIOOOOOUUUUCnN'
+)
+
+@functools.lru_cache(maxsize=256)
 def normalize_keyword(keyword: str) -> str:
     """
     Converte a palavra-chave para um formato ASCII limpo, removendo acentos e
     convertendo para minúsculas, para garantir compatibilidade com a busca 'q' da API.
     """
-    # Normaliza para NFD (separa caractere base de acento), remove diacríticos (acentos),
-    # decodifica para string e converte para minúsculas.
-    keyword_ascii = unicodedata.normalize('NFD', keyword).encode('ascii', 'ignore').decode("utf-8").lower()
-    return keyword_ascii
+    # Caminho rápido: acentos do português via tabela de tradução.
+    keyword_ascii = keyword.translate(_ACCENT_MAP)
+    if keyword_ascii.isascii():
+        return keyword_ascii.lower()
+
+    # Fallback para outros caracteres: normaliza para NFD (separa caractere base de acento),
+    # remove diacríticos (acentos), decodifica para string e converte para minúsculas.
+    return unicodedata.normalize('NFD', keyword_ascii).encode('ascii', 'ignore').decode("utf-8").lower()
+
+def _salvar_token(creds: Credentials) -> None:
+    """
+    Grava as credenciais em 'token.json' somente se o conteúdo mudou desde a última escrita.
+    """
+    global _TOKEN_JSON
+    token_json = creds.to_json()
+    if token_json == _TOKEN_JSON:
+        return
+    with open('token.json', 'w') as token:
+        token.write(token_json)
+    _TOKEN_JSON = token_json
+
+def _build_request(http, *args, **kwargs):
+    """
+    Cria cada HttpRequest com o AuthorizedHttp da thread atual.
+    O httplib2 não é thread-safe, e o serviço em cache é usado a partir do pool de threads do agente;
+    do 'http' do serviço usamos apenas as credenciais, e cada thread mantém as próprias conexões.
+    """
+    creds = http.credentials
+    if getattr(_THREAD_HTTP, 'creds', None) is not creds:
+        _THREAD_HTTP.creds = creds
+        _THREAD_HTTP.http = AuthorizedHttp(creds, http=httplib2.Http())
+    return HttpRequest(_THREAD_HTTP.http, *args, **kwargs)
 
 def get_calendar_service():
     """
     Autentica e obtém o objeto de serviço da API do Google Calendar (v3).
-    Gerencia o carregamento, refresh e salvamento do arquivo 'token.json'.
+    Usa a conta de serviço de GOOGLE_SERVICE_ACCOUNT_FILE quando definida; caso contrário,
+    gerencia o carregamento, refresh e salvamento do arquivo 'token.json'.
+    O serviço é construído uma única vez e reaproveitado enquanto as credenciais forem válidas.
 
     Retorna:
         Objeto googleapiclient.discovery.Resource para interagir com a API.
     """
-    creds = None
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-    
-    # Se o token estiver expirado e houver um refresh token, tenta renovar.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            # Caso contrário, inicia o fluxo de autenticação via navegador.
-            flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
-        
-        # Salva as credenciais atualizadas no arquivo.
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
+    global _SERVICE, _CREDS, _TOKEN_JSON, _FREEBUSY_ATIVO
+
+    # Caminho rápido: serviço já construído e credenciais ainda válidas.
+    if _SERVICE is not None and _CREDS is not None and _CREDS.valid:
+        return _SERVICE
+
+    with _SERVICE_LOCK:
+        # Outra thread pode ter inicializado o serviço enquanto esperávamos o lock.
+        if _SERVICE is not None and _CREDS is not None and _CREDS.valid:
+            return _SERVICE
+
+        # Em produção, uma conta de serviço (com delegação para o usuário) evita o fluxo via navegador.
+        service_account_file = os.getenv('GOOGLE_SERVICE_ACCOUNT_FILE')
+        user_email = os.getenv('GOOGLE_CALENDAR_USER_EMAIL')
 
-    return build('calendar', 'v3', credentials=creds)
+        creds = _CREDS
+        if creds is None and service_account_file:
+            creds = service_account.Credentials.from_service_account_file(service_account_file, scopes=SCOPES)
+            if user_email:
+                creds = creds.with_subject(user_email)
+        elif creds is None and os.path.exists('token.json'):
+            with open('token.json') as token:
+                _TOKEN_JSON = token.read()
+            # Carrega com os escopos concedidos (gravados no token), não com os solicitados,
+            # para detectar tokens antigos emitidos sem algum dos SCOPES atuais.
+            creds = Credentials.from_authorized_user_info(json.loads(_TOKEN_JSON))
+            if not creds.has_scopes(SCOPES):
+                # Sem reautorizar aqui (travaria servidores sem navegador): o token continua
+                # válido para eventos, e o FreeBusy cai no lote de eventos após o primeiro 403.
+                logging.warning(
+                    "token.json não possui o escopo calendar.freebusy; "
+                    "rode 'python autenticacao.py' para autorizar novamente."
+                )
+
+        if isinstance(creds, service_account.Credentials):
+            # Conta de serviço: o token é renovado sem interação e não há arquivo a salvar.
+            if not creds.valid:
+                creds.refresh(Request())
+        # Se o token estiver expirado e houver um refresh token, tenta renovar.
+        elif not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                creds.refresh(Request())
+            else:
+                # Caso contrário, inicia o fluxo de autenticação via navegador.
+                flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
+                creds = flow.run_local_server(port=0)
+
+            # Salva as credenciais atualizadas no arquivo (apenas se mudaram).
+            _salvar_token(creds)
+
+        # O serviço só precisa ser reconstruído quando as credenciais mudam de objeto;
+        # após um refresh, o Resource existente já enxerga o novo token.
+        # Nenhum dos caminhos busca o discovery na rede: usa o arquivo fixado, se existir,
+        # ou o documento estático embutido no google-api-python-client.
+        if _SERVICE is None or creds is not _CREDS:
+            _FREEBUSY_ATIVO = True # Novas credenciais podem ter o escopo que faltava
+            http = AuthorizedHttp(creds, http=httplib2.Http())
+            if os.path.exists(DISCOVERY_FILE):
+                with open(DISCOVERY_FILE) as discovery:
+                    _SERVICE = build_from_document(discovery.read(), http=http, requestBuilder=_build_request)
+            else:
+                _SERVICE = build(
+                    'calendar', 'v3',
+                    http=http,
+                    requestBuilder=_build_request,
+                    cache_discovery=False,
+                    static_discovery=True,
+                )
+        _CREDS = creds
+
+        return _SERVICE
+
+def initialize_calendar() -> None:
+    """
+    Aquece a autenticação e o serviço do Calendar na inicialização do agente,
+    para que nenhum fluxo de autenticação bloqueie o atendimento da primeira mensagem.
+    """
+    get_calendar_service()
+    logging.info("Serviço do Google Calendar inicializado.")
 
 def format_datetime_for_query(dt_object: datetime.datetime) -> str:
     """
@@ -67,34 +197,71 @@ def format_datetime_for_query(dt_object: datetime.datetime) -> str:
     # Garante o formato 'Z' (Zulu Time/UTC) sem o offset '+00:00' que causa o 400 Bad Request.
     return dt_truncated.strftime('%Y-%m-%dT%H:%M:%S') + 'Z'
 
-# --- Funções de Ferramentas (Tools) do Agente ---
+def _parse_rfc3339(value: str) -> datetime.datetime:
+    """
+    Converte um timestamp RFC 3339 da API (que pode terminar em 'Z') em datetime com fuso.
+    """
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    return datetime.datetime.fromisoformat(value)
+
+class FreeBusyError(Exception):
+    """O FreeBusy respondeu, mas reportou erro no próprio calendário (campo 'errors')."""
 
-def verificar_disponibilidade(start_time_iso: str, end_time_iso: str) -> bool:
+def _parse_freebusy(response: dict) -> list[tuple[datetime.datetime, datetime.datetime]]:
     """
-    Verifica se o calendário primário está livre no intervalo especificado.
+    Extrai os intervalos ocupados do calendário primário de uma resposta FreeBusy.
+    Levanta FreeBusyError se a API reportar erro no calendário, em vez de tratar tudo como livre.
+    """
+    calendar = response['calendars']['primary']
+    if calendar.get('errors'):
+        raise FreeBusyError(f"Erro no FreeBusy do calendário primário: {calendar['errors']}")
+
+    busy = calendar.get('busy', [])
+    return sorted((_parse_rfc3339(b['start']), _parse_rfc3339(b['end'])) for b in busy)
+
+def consultar_intervalos_ocupados(service, time_min_iso: str, time_max_iso: str) -> list[tuple[datetime.datetime, datetime.datetime]]:
+    """
+    Obtém, em uma única requisição FreeBusy, os intervalos ocupados do calendário primário.
 
     Args:
-        start_time_iso: Início do intervalo no formato ISO 8601 com fuso horário.
-        end_time_iso: Fim do intervalo no formato ISO 8601 com fuso horário.
+        service: Objeto de serviço retornado por get_calendar_service().
+        time_min_iso: Início da janela consultada no formato ISO 8601 com fuso horário.
+        time_max_iso: Fim da janela consultada no formato ISO 8601 com fuso horário.
 
     Retorna:
-        True se estiver livre, False se estiver ocupado (eventos encontrados).
+        Lista ordenada de tuplas (inicio, fim) dos intervalos ocupados.
+
+    Levanta:
+        HttpError se a requisição falhar; FreeBusyError se o calendário reportar erro.
     """
-    service = get_calendar_service()
-    
-    # A consulta de eventos usa 'singleEvents=True' e 'orderBy' para ser mais robusta.
-    events_result = service.events().list(
-        calendarId='primary',
-        timeMin=start_time_iso,
-        timeMax=end_time_iso,
-        singleEvents=True,
-        orderBy='startTime'
-    ).execute()
-    
-    events = events_result.get('items', [])
-    
-    # Se encontrou eventos, o horário está ocupado
-    return not events
+    response = service.freebusy().query(body={
+        'timeMin': time_min_iso,
+        'timeMax': time_max_iso,
+        'items': [{'id': 'primary'}],
+    }).execute()
+
+    return _parse_freebusy(response)
+
+def intervalo_livre(start_dt: datetime.datetime, end_dt: datetime.datetime, busy: list[tuple[datetime.datetime, datetime.datetime]]) -> bool:
+    """
+    Verifica localmente se o intervalo [start_dt, end_dt) não intersecta nenhum intervalo ocupado.
+    """
+    for busy_start, busy_end in busy:
+        if busy_start >= end_dt:
+            break # Lista ordenada: nenhum intervalo seguinte pode intersectar
+        if busy_end > start_dt:
+            return False
+    return True
+
+def _disponibilidade_em_cache(key: tuple[str, str]) -> bool | None:
+    """
+    Retorna a disponibilidade em cache para (inicio_iso, fim_iso), ou None se não houver.
+    """
+    with _avail_cache_lock:
+        return _avail_cache.get(key)
+
+# --- Funções de Ferramentas (Tools) do Agente ---
 
 def criar_evento(summary: str, start_time_iso: str, end_time_iso: str) -> str:
     """
@@ -123,35 +290,119 @@ def criar_evento(summary: str, start_time_iso: str, end_time_iso: str) -> str:
     }
     
     event = service.events().insert(calendarId='primary', body=event).execute()
+
+    # O novo evento invalida as disponibilidades em cache, inclusive as ainda em consulta
+    global _avail_cache_geracao
+    with _avail_cache_lock:
+        _avail_cache_geracao += 1
+        _avail_cache.clear()
+
     return event.get('htmlLink')
 
-def sugerir_horarios(start_time_iso: str, end_time_iso: str) -> list[str]:
+def _intervalos_livres(service, candidatos: list[tuple[datetime.datetime, datetime.datetime]]) -> list[bool]:
     """
-    Sugere horários subsequentes (30, 60, 90 minutos após) se o horário original estiver ocupado.
+    Verifica quais intervalos candidatos estão livres com o mínimo de round-trips.
 
-    Args:
-        start_time_iso: O horário inicial ocupado.
-        end_time_iso: O horário final do intervalo (usado para calcular a duração).
+    Uma única consulta FreeBusy cobre a janela de todos os candidatos; se o FreeBusy falhar,
+    as consultas de eventos são enviadas em um único lote HTTP (BatchHttpRequest).
+    Um 403 (permissão negada) desliga o FreeBusy até que as credenciais sejam refeitas.
 
     Retorna:
-        Uma lista de strings ISO 8601 dos novos horários de início disponíveis.
+        Lista de booleanos, na mesma ordem dos candidatos (True = livre).
     """
-    start_time_dt = datetime.datetime.fromisoformat(start_time_iso)
-    
-    suggestions_iso = []
-    
-    # Tenta 30, 60 e 90 minutos depois do horário original
+    global _FREEBUSY_ATIVO
+
+    if _FREEBUSY_ATIVO:
+        try:
+            busy = consultar_intervalos_ocupados(
+                service,
+                min(start for start, _ in candidatos).isoformat(),
+                max(end for _, end in candidatos).isoformat(),
+            )
+            return [intervalo_livre(start, end, busy) for start, end in candidatos]
+        except HttpError as e:
+            if e.resp.status == 403:
+                _FREEBUSY_ATIVO = False
+                logging.warning(f"FreeBusy sem permissão; usando apenas o lote de eventos (regenere o token.json): {e}")
+            else:
+                logging.warning(f"FreeBusy indisponível, usando requisição em lote de eventos: {e}")
+        except FreeBusyError as e:
+            logging.warning(f"FreeBusy indisponível, usando requisição em lote de eventos: {e}")
+
+    # Fallback: envia as consultas de eventos em um único lote HTTP
+    livres = {}
+
+    def _callback(request_id, response, exception):
+        if exception is not None:
+            logging.error(f"Erro ao verificar o horário {request_id}: {exception}")
+            livres[request_id] = False
+        else:
+            livres[request_id] = not response.get('items', [])
+
+    batch = service.new_batch_http_request(callback=_callback)
+    for i, (start, end) in enumerate(candidatos):
+        batch.add(
+            service.events().list(
+                calendarId='primary',
+                timeMin=start.isoformat(),
+                timeMax=end.isoformat(),
+                singleEvents=True,
+                orderBy='startTime'
+            ),
+            request_id=str(i),
+        )
+    batch.execute()
+
+    return [livres.get(str(i), False) for i in range(len(candidatos))]
+
+def _candidatos_sugestao(start_time_dt: datetime.datetime) -> list[tuple[datetime.datetime, datetime.datetime]]:
+    """
+    Monta os intervalos sugeridos (30, 60 e 90 minutos após o início), mantendo 1h de duração.
+    """
+    candidatos = []
     for offset in [30, 60, 90]:
         new_start_time = start_time_dt + datetime.timedelta(minutes=offset)
-        new_end_time = new_start_time + datetime.timedelta(hours=1) # Mantém 1h de duração
-        
-        new_start_time_iso = new_start_time.isoformat()
-        new_end_time_iso = new_end_time.isoformat()
+        candidatos.append((new_start_time, new_start_time + datetime.timedelta(hours=1)))
+    return candidatos
 
-        if verificar_disponibilidade(new_start_time_iso, new_end_time_iso):
-            suggestions_iso.append(new_start_time_iso)
-            
-    return suggestions_iso
+def check_and_suggest(start_time_iso: str, end_time_iso: str) -> tuple[bool, list[tuple[str, datetime.datetime]]]:
+    """
+    Verifica a disponibilidade do intervalo e, se estiver ocupado, sugere horários alternativos,
+    tudo com uma única consulta FreeBusy (janela de início até início + 2h30).
+
+    Args:
+        start_time_iso: Início do intervalo no formato ISO 8601 com fuso horário.
+        end_time_iso: Fim do intervalo no formato ISO 8601 com fuso horário.
+
+    Retorna:
+        Tupla (disponivel, sugestoes). As sugestões são tuplas (ISO 8601, datetime) dos
+        horários de início livres (30, 60 e 90 minutos após) e só são retornadas quando
+        o horário está ocupado; o datetime já processado evita reprocessar a string.
+    """
+    key = (start_time_iso, end_time_iso)
+    if _disponibilidade_em_cache(key):
+        return True, []
+
+    service = get_calendar_service()
+    start_time_dt = datetime.datetime.fromisoformat(start_time_iso)
+    end_time_dt = datetime.datetime.fromisoformat(end_time_iso)
+    candidatos = _candidatos_sugestao(start_time_dt)
+
+    with _avail_cache_lock:
+        geracao = _avail_cache_geracao
+    disponivel, *livres = _intervalos_livres(service, [(start_time_dt, end_time_dt)] + candidatos)
+    with _avail_cache_lock:
+        # Um evento criado durante a consulta pode ter ocupado o horário: não grava a resposta.
+        if geracao == _avail_cache_geracao:
+            _avail_cache[key] = disponivel
+
+    if disponivel:
+        return True, []
+    return False, [
+        (new_start.isoformat(), new_start)
+        for (new_start, _), livre in zip(candidatos, livres)
+        if livre
+    ]
 
 def obter_eventos_por_palavra_chave(keyword: str) -> list[dict]:
     """
@@ -189,7 +440,6 @@ def obter_eventos_por_palavra_chave(keyword: str) -> list[dict]:
 
     # Processa e formata os eventos para exibição
     results = []
-    brazil_timezone = pytz.timezone(TIMEZONE_BRAZIL)
     
     for event in events:
         # Pega o 'dateTime' para eventos com hora ou 'date' para eventos de dia inteiro
@@ -197,11 +447,29 @@ def obter_eventos_por_palavra_chave(keyword: str) -> list[dict]:
         dt_obj = datetime.datetime.fromisoformat(start)
         
         # Converte o horário para o fuso horário de exibição (Brasil)
-        local_time = dt_obj.astimezone(brazil_timezone)
+        local_time = dt_obj.astimezone(FUSO_BRASIL)
         
         results.append({
             'titulo': event['summary'],
             'data_hora': local_time.strftime('%d/%m às %H:%M')
         })
         
-    return results
\ No newline at end of file
+    return results
+
+# --- Versões Assíncronas das Ferramentas ---
+# Executam as chamadas bloqueantes do googleapiclient no pool de threads do event loop,
+# concentrando aqui o ponto de troca caso o cliente HTTP passe a ser assíncrono.
+
+async def acriar_evento(summary: str, start_time_iso: str, end_time_iso: str) -> str:
+    """Versão assíncrona de criar_evento."""
+    return await asyncio.to_thread(criar_evento, summary, start_time_iso, end_time_iso)
+
+async def acheck_and_suggest(start_time_iso: str, end_time_iso: str) -> tuple[bool, list[tuple[str, datetime.datetime]]]:
+    """Versão assíncrona de check_and_suggest; um horário livre em cache não usa thread."""
+    if _disponibilidade_em_cache((start_time_iso, end_time_iso)):
+        return True, []
+    return await asyncio.to_thread(check_and_suggest, start_time_iso, end_time_iso)
+
+async def aobter_eventos_por_palavra_chave(keyword: str) -> list[dict]:
+    """Versão assíncrona de obter_eventos_por_palavra_chave."""
+    return await asyncio.to_thread(obter_eventos_por_palavra_chave, keyword)